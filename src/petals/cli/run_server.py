@@ -1,10 +1,13 @@
 import argparse
+import os
 
 import configargparse
+import torch
 from hivemind.proto.runtime_pb2 import CompressionType
 from hivemind.utils.limits import increase_file_limit
 from hivemind.utils.logging import get_logger
 from humanfriendly import parse_size
+from packaging import version
 
 from petals.constants import DTYPE_MAP, PUBLIC_INITIAL_PEERS
 from petals.server.server import Server
@@ -79,6 +82,14 @@ def main():
     parser.add_argument('--attn_cache_tokens', type=int, default=None,
                         help='The number of past attention key/value pairs that will be stored between inference steps. '
                              'Default: 8192 for most models, 32768 for models with multi-query attention (e.g., Llama-2-70b)')
+    parser.add_argument('--attn_cache_offload_size', type=str, default=None,
+                        help='Allow storing this much attention cache in RAM (e.g., 16GiB) in addition to --attn_cache_tokens. '
+                             'Caches of least recently used inference sessions are moved there when GPU memory is full. '
+                             'Default: do not offload')
+    parser.add_argument('--prefix_cache_tokens', type=int, default=0,
+                        help='Keep attention caches for this many tokens of prompt prefixes (per block) to reuse them '
+                             'in other inference sessions with the same prefix (e.g., a common system prompt). '
+                             'Default: 0 (disabled)')
 
     parser.add_argument('--cache_dir', type=str, default=None,
                         help='Path to a directory in which a downloaded pretrained model configuration should be cached if the standard cache should not be used.')
@@ -96,6 +107,10 @@ def main():
     parser.add_argument("--torch_dtype", type=str, choices=DTYPE_MAP.keys(), default="auto",
                         help="Use this dtype to store block weights and do computations. "
                              "By default, respect the dtypes in the pre-trained state dict.")
+    parser.add_argument("--kv_cache_dtype", type=str, choices=["auto", "int8"], default="auto",
+                        help="Store attention keys/values in this dtype. 'int8' quantizes them with one scale "
+                             "per head and token, which fits ~2x more tokens into the attention cache. "
+                             "By default, use the same dtype as --torch_dtype")
     parser.add_argument('--alloc_timeout', type=float, default=1,
                         help='If the cache is full, the server will wait for this number of seconds hoping that some memory will be freed '
                              'before rejecting the request')
@@ -153,6 +168,10 @@ def main():
                         "Split each block between the specified GPUs such that each device holds a portion of every "
                         "weight matrix. See https://huggingface.co/transformers/v4.9.0/parallelism.html#tensor-parallelism")
 
+    parser.add_argument("--torch_compile", action='store_true',
+                        help="Compile transformer blocks with torch.compile() to fuse their kernels (requires torch>=2.0). "
+                             "Blocks are compiled at startup, which may take a few minutes. Experimental")
+
     parser.add_argument("--skip_reachability_check", action='store_true',
                         help="Skip checking this server's reachability via health.petals.dev "
                              "when connecting to the public swarm. If you connect to a private swarm, "
@@ -198,6 +217,10 @@ def main():
         max_disk_space, (int, type(None))
     ), "Unrecognized value for --max_disk_space. Correct examples: 1.5GB or 1500MB or 1572864000 (bytes)"
 
+    attn_cache_offload_size = args.pop("attn_cache_offload_size")
+    if attn_cache_offload_size is not None:
+        args["attn_cache_offload_bytes"] = parse_size(attn_cache_offload_size)
+
     if args.pop("new_swarm"):
         args["initial_peers"] = []
 
@@ -207,6 +230,11 @@ def main():
 
     validate_version()
 
+    if version.parse(torch.__version__) >= version.parse("2.1.0"):
+        # Attention caches are allocated, grown, and freed as inference sessions come and go. Expandable segments
+        # let the CUDA caching allocator reuse this memory instead of fragmenting it. This must be set before CUDA init
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
     server = Server(
         **args,
         host_maddrs=host_maddrs,
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import dataclasses
 from collections import Counter
 from itertools import chain
-from typing import Any, Dict, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind import BatchTensorDescriptor, TensorDescriptor
@@ -15,8 +16,9 @@ from transformers import PretrainedConfig
 
 from petals.data_structures import InferenceMetadata
 from petals.server.memory_cache import MemoryCache
+from petals.server.prefix_cache import PrefixCache
 from petals.server.task_pool import PrioritizedTaskPool
-from petals.utils.misc import is_dummy
+from petals.utils.misc import get_dtype_size, is_dummy
 
 logger = get_logger(__name__)
 
@@ -33,6 +35,7 @@ class TransformerBackend(ModuleBackend):
         memory_cache: MemoryCache,
         backend_dtype: torch.dtype,
         max_chunk_size_bytes: int,
+        cache_dtype: Optional[torch.dtype] = None,
         **kwargs,
     ):
         import petals.utils.peft as _peft_module
@@ -64,6 +67,8 @@ class TransformerBackend(ModuleBackend):
 
         self.dtype = backend_dtype
         self.dtype_bytes = torch.finfo(self.dtype).bits // 8
+        self.cache_dtype = cache_dtype if cache_dtype is not None else backend_dtype
+        assert self.cache_dtype in (self.dtype, torch.int8), f"Unsupported cache dtype: {self.cache_dtype}"
         self.shard_num_heads = []
         for shard in self.module.module_shards:
             for submodule in shard.modules():
@@ -83,19 +88,26 @@ class TransformerBackend(ModuleBackend):
 
         self.cache_bytes_per_token: Dict[torch.device, int] = Counter()
         for descr in self.get_inference_cache_descriptors(batch_size=1, max_length=1):
-            self.cache_bytes_per_token[descr.device] += descr.numel() * torch.finfo(descr.dtype).bits // 8
+            self.cache_bytes_per_token[descr.device] += descr.numel() * get_dtype_size(descr.dtype)
 
     def get_inference_cache_descriptors(self, batch_size: int, max_length: int) -> Sequence[TensorDescriptor]:
-        """Create tensor descriptors for attention cache tensors used during inference_step"""
+        """
+        Create tensor descriptors for attention cache tensors used during inference_step
+
+        :returns: one tensor with both keys and values [2, batch_size, num_kv_heads, max_length, head_dim] for each
+          device, followed by their scales [2, batch_size, num_kv_heads, max_length, 1] for each device if cache is int8
+        """
         head_dim = self.config.hidden_size // self.config.num_attention_heads
-        cache_tensors = []
+        cache_tensors, cache_scales = [], []
         for device, num_heads in zip(self.module.devices, self.shard_num_heads):
             num_heads //= self.config.num_key_value_groups
-            keys = TensorDescriptor((batch_size, num_heads, head_dim, max_length), dtype=self.dtype, device=device)
-            values = TensorDescriptor((batch_size, num_heads, max_length, head_dim), dtype=self.dtype, device=device)
-            cache_tensors.extend((keys, values))
-        return cache_tensors
+            shape = (2, batch_size, num_heads, max_length, head_dim)
+            cache_tensors.append(TensorDescriptor(shape, dtype=self.cache_dtype, device=device))
+            if self.cache_dtype == torch.int8:  # one scale per head for each token
+                cache_scales.append(TensorDescriptor((*shape[:-1], 1), dtype=self.dtype, device=device))
+        return cache_tensors + cache_scales
 
+    @torch.inference_mode()
     def forward(self, *inputs: Union[torch.Tensor, str]) -> Tuple[torch.Tensor, ...]:
         *inputs, active_adapter = inputs
         with self._peft_module.using_adapter(active_adapter):
@@ -152,17 +164,33 @@ class TransformerBackend(ModuleBackend):
     def _reorder_cache_inplace(self, cache_tensors: torch.Tensor, hypo_ids: torch.Tensor):
         """If hypo_ids is specified, reorder elements of each cache tensor in-place by taking indices from hypo_ids"""
         if not is_dummy(hypo_ids):
-            for cache_tensor in cache_tensors:
-                cache_tensor[...] = cache_tensor[hypo_ids.to(cache_tensor.device)]  # in-place reorder cache by hypo ids
+            for cache_tensor in cache_tensors:  # note: batch is the 2nd dim, see get_inference_cache_descriptors
+                cache_tensor[...] = cache_tensor[:, hypo_ids.to(cache_tensor.device)]  # in-place reorder by hypo ids
+
+    def _split_cache_tensors(
+        self, cache_tensors: Sequence[torch.Tensor]
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor], List[torch.Tensor], List[torch.Tensor]]:
+        """
+        Get views of keys [batch, num_kv_heads, head_dim, length] and values [batch, num_kv_heads, length, head_dim]
+        for each device, followed by their scales ([..., 1, length] and [..., length, 1]) if the cache is int8
+        """
+        num_devices = len(self.module.devices)
+        kv_caches, kv_scales = cache_tensors[:num_devices], cache_tensors[num_devices:]
+        key_cache, value_cache = [kv[0].transpose(-1, -2) for kv in kv_caches], [kv[1] for kv in kv_caches]
+        key_scales, value_scales = [sc[0].transpose(-1, -2) for sc in kv_scales], [sc[1] for sc in kv_scales]
+        return key_cache, value_cache, key_scales, value_scales
 
     def _select_layer_past(self, cache_tensors: Sequence[torch.Tensor], prefix_length: int) -> Sequence[torch.Tensor]:
         """Extract first {prefix_length} tokens and reshape them such that they can be used as layer_past"""
-        key_cache, value_cache = list(cache_tensors[0::2]), list(cache_tensors[1::2])
+        key_cache, value_cache, key_scales, value_scales = self._split_cache_tensors(cache_tensors)
         for i in range(len(key_cache)):
             key_cache[i] = key_cache[i].flatten(0, 1)[:, :, :prefix_length]
             # shape: [batch * num_kv_heads, head_dim, kv_length]
             value_cache[i] = value_cache[i].flatten(0, 1)[:, :prefix_length]
             # shape: [batch * num_kv_heads, kv_length, head_dim]
+            if self.cache_dtype == torch.int8:
+                key_cache[i] = key_cache[i].to(self.dtype) * key_scales[i].flatten(0, 1)[:, :, :prefix_length]
+                value_cache[i] = value_cache[i].to(self.dtype) * value_scales[i].flatten(0, 1)[:, :prefix_length]
         layer_past = tuple(chain(*zip(key_cache, value_cache)))
         return PerDeviceTensors(*layer_past) if len(self.module.module_shards) > 1 else layer_past
 
@@ -171,12 +199,50 @@ class TransformerBackend(ModuleBackend):
     ):
         """Writes new key/value tensors back into cache, works in-place"""
         _batch_size_times_num_kv_heads, head_dim, new_length = new_kvs[0].shape
-        for cache_key, new_key in zip(cache_tensors[0::2], new_kvs[0::2]):
-            new_key = new_key.view(*cache_key.shape[:3], new_length)
-            cache_key[:, :, :, prefix_length:new_length] = new_key[:, :, :, prefix_length:new_length]
-        for cache_value, new_value in zip(cache_tensors[1::2], new_kvs[1::2]):
-            new_value = new_value.view(*cache_value.shape[:2], new_length, head_dim)
-            cache_value[:, :, prefix_length:new_length, :] = new_value[:, :, prefix_length:new_length, :]
+        key_cache, value_cache, key_scales, value_scales = self._split_cache_tensors(cache_tensors)
+        for i, (cache_key, new_key) in enumerate(zip(key_cache, new_kvs[0::2])):
+            new_key = new_key.view(*cache_key.shape[:3], new_length)[:, :, :, prefix_length:new_length]
+            if self.cache_dtype == torch.int8:
+                new_key, key_scales[i][:, :, :, prefix_length:new_length] = _quantize_int8(new_key, dim=2)
+            cache_key[:, :, :, prefix_length:new_length] = new_key
+        for i, (cache_value, new_value) in enumerate(zip(value_cache, new_kvs[1::2])):
+            new_value = new_value.view(*cache_value.shape[:2], new_length, head_dim)[:, :, prefix_length:new_length, :]
+            if self.cache_dtype == torch.int8:
+                new_value, value_scales[i][:, :, prefix_length:new_length, :] = _quantize_int8(new_value, dim=3)
+            cache_value[:, :, prefix_length:new_length, :] = new_value
+
+    @staticmethod
+    def read_cache(cache_tensors: Sequence[torch.Tensor], start: int, end: int) -> Tuple[torch.Tensor, ...]:
+        """Copy tokens [start, end) from each cache tensor, e.g. to reuse them in other inference sessions"""
+        return tuple(tensor.narrow(3, start, end - start).clone() for tensor in cache_tensors)  # dim 3 is length
+
+    @staticmethod
+    def write_cache(cache_tensors: Sequence[torch.Tensor], chunks: Sequence[torch.Tensor], start: int):
+        """Write tokens returned by read_cache() to each cache tensor starting from a given position, in-place"""
+        for tensor, chunk in zip(cache_tensors, chunks):
+            tensor.narrow(3, start, chunk.shape[3]).copy_(chunk)
+
+    def warmup(self) -> None:
+        """
+        Run the block on dummy inputs for forward, backward, prefill and decoding steps (e.g., to trigger torch.compile),
+        with batch sizes 1 and 2 since torch.compile specializes graphs for size 1 even with dynamic=True
+        """
+        device = self.module.devices[self.module.output_device_index]
+        for batch_size in (1, 2):
+            hidden_states = torch.zeros(batch_size, 2, self.config.hidden_size, dtype=self.dtype, device=device)
+            with torch.inference_mode():
+                self.module.forward(hidden_states)
+            self.backward(hidden_states, torch.zeros_like(hidden_states), "")  # runs forward with grad enabled, too
+
+            cache_descriptors = self.get_inference_cache_descriptors(batch_size=batch_size, max_length=3)
+            cache_tensors = [descr.make_zeros() for descr in cache_descriptors]
+            with torch.inference_mode():
+                for prefix_length, seq_length in [(0, 2), (2, 1)]:
+                    hidden_states = torch.zeros(
+                        batch_size, seq_length, self.config.hidden_size, dtype=self.dtype, device=device
+                    )
+                    layer_past = self._select_layer_past(cache_tensors, prefix_length)
+                    self.module.forward(hidden_states, layer_past=layer_past, use_cache=True)
 
     def get_pools(self) -> Sequence[PrioritizedTaskPool]:
         return self.forward_pool, self.backward_pool, self.inference_pool
@@ -196,12 +262,25 @@ class TransformerBackend(ModuleBackend):
             p.data = dummy
 
 
-def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]):
-    """Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call"""
+def _quantize_int8(tensor: torch.Tensor, dim: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Quantize a tensor to int8 with one absmax scale per slice along {dim}, such that tensor ~= values * scales"""
+    scales = tensor.abs().amax(dim=dim, keepdim=True).float().clamp_min(1e-8) / 127
+    values = (tensor.float() / scales).round_().clamp_(-127, 127).to(torch.int8)
+    return values, scales.to(tensor.dtype)
+
+
+def merge_inference_pools_inplace(
+    backends: Dict[ExpertUID, TransformerBackend], prefix_cache: Optional[PrefixCache] = None
+):
+    """
+    Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call
+
+    :param prefix_cache: if specified, reuse attention caches for prompt prefixes seen in previous inference sessions
+    """
     assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
     first_pool = next(iter(backends.values())).inference_pool
     merged_pool = PrioritizedTaskPool(
-        _MergedInferenceStep(backends),
+        _MergedInferenceStep(backends, prefix_cache),
         max_batch_size=first_pool.max_batch_size,
         device=first_pool.device,
         name=f"merged_inference",
@@ -211,10 +290,46 @@ def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend])
         backend.inference_pool = merged_pool
 
 
-class _MergedInferenceStep:
+def merge_forward_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]):
+    """Replace each backend's forward pools with a combined pool that runs multiple blocks in one call"""
+    assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
+    first_pool = next(iter(backends.values())).forward_pool
+    merged_pool = PrioritizedTaskPool(
+        _MergedForwardStep(backends),
+        max_batch_size=first_pool.max_batch_size,
+        device=first_pool.device,
+        name=f"merged_forward",
+    )
+    for backend in backends.values():
+        assert not backend.forward_pool.is_alive()
+        backend.forward_pool = merged_pool
+
+
+class _MergedForwardStep:
     def __init__(self, backends: Dict[ExpertUID, TransformerBackend]):
         self.backends = backends
 
+    @torch.inference_mode()
+    def __call__(
+        self,
+        hidden_states: torch.Tensor,
+        active_adapter: str,
+        uids: Sequence[ExpertUID],
+        *optional_prompts: Optional[torch.Tensor],
+    ) -> Tuple[torch.Tensor, ...]:
+        assert len(uids) == len(optional_prompts), f"found {len(uids)} blocks but {len(optional_prompts)} prompts"
+        for uid, optional_prompt in zip(uids, optional_prompts):
+            if optional_prompt is not None:
+                hidden_states[:, : optional_prompt.shape[1]] += optional_prompt
+            (hidden_states,) = self.backends[uid].forward(hidden_states, active_adapter)
+        return (hidden_states,)
+
+
+class _MergedInferenceStep:
+    def __init__(self, backends: Dict[ExpertUID, TransformerBackend], prefix_cache: Optional[PrefixCache] = None):
+        self.backends = backends
+        self.prefix_cache = prefix_cache
+
     @torch.inference_mode()
     def __call__(
         self,
@@ -226,8 +341,73 @@ class _MergedInferenceStep:
         assert len(inference_infos) == len(
             optional_prompts
         ), f"found {len(inference_infos)} blocks but {len(optional_prompts)} prompts"
+        if (
+            self.prefix_cache is not None
+            and all(inference_info.prefix_length == 0 for inference_info in inference_infos)
+            and all(optional_prompt is None for optional_prompt in optional_prompts)
+            and is_dummy(hypo_ids)
+        ):
+            return (self._inference_step_with_prefix_cache(hidden_states, hypo_ids, inference_infos),)
+        return (self._inference_step(hidden_states, hypo_ids, inference_infos, optional_prompts),)
+
+    def _inference_step(
+        self,
+        hidden_states: torch.Tensor,
+        hypo_ids: torch.LongTensor,
+        inference_infos: Sequence[InferenceMetadata],
+        optional_prompts: Sequence[Optional[torch.Tensor]],
+    ) -> torch.Tensor:
         for inference_info, optional_prompt in zip(inference_infos, optional_prompts):
             if optional_prompt is not None:
                 hidden_states[:, : optional_prompt.shape[1]] += optional_prompt
             (hidden_states,) = self.backends[inference_info.uid].inference_step(hidden_states, hypo_ids, inference_info)
-        return (hidden_states,)
+        return hidden_states
+
+    def _inference_step_with_prefix_cache(
+        self, hidden_states: torch.Tensor, hypo_ids: torch.LongTensor, inference_infos: Sequence[InferenceMetadata]
+    ) -> torch.Tensor:
+        """Run the first step of an inference session, reuse cached results for the longest known prefix of inputs"""
+        namespace = tuple((inference_info.uid, inference_info.active_adapter) for inference_info in inference_infos)
+        keys = self.prefix_cache.get_keys(hidden_states, namespace)
+        chunk_length = self.prefix_cache.chunk_length
+
+        cached_entries = []  # each entry is (output hidden states, [cache tensors for each block]) for one chunk
+        for key in keys:
+            entry = self.prefix_cache.get(key)
+            if entry is None:
+                break
+            cached_entries.append(entry)
+        cached_length = len(cached_entries) * chunk_length
+
+        if cached_entries:
+            for i, inference_info in enumerate(inference_infos):
+                backend = self.backends[inference_info.uid]
+                with backend.memory_cache.use_cache(*inference_info.cache_handles) as cache_tensors:
+                    for chunk_index, (_, cache_chunks) in enumerate(cached_entries):
+                        backend.write_cache(cache_tensors, cache_chunks[i], start=chunk_index * chunk_length)
+
+        outputs = [entry[0] for entry in cached_entries]
+        if cached_length < hidden_states.shape[1]:
+            inference_infos = [dataclasses.replace(info, prefix_length=cached_length) for info in inference_infos]
+            outputs.append(
+                self._inference_step(
+                    hidden_states[:, cached_length:], hypo_ids, inference_infos, [None] * len(inference_infos)
+                )
+            )
+        outputs = torch.cat(outputs, dim=1) if cached_length > 0 else outputs[0]  # never return cached tensors as is
+        if len(keys) == len(cached_entries):
+            return outputs
+
+        new_cache_chunks = [[] for _ in keys[len(cached_entries) :]]
+        for inference_info in inference_infos:
+            backend = self.backends[inference_info.uid]
+            with backend.memory_cache.use_cache(*inference_info.cache_handles) as cache_tensors:
+                for chunk_index in range(len(cached_entries), len(keys)):
+                    start = chunk_index * chunk_length
+                    chunks = backend.read_cache(cache_tensors, start, start + chunk_length)
+                    new_cache_chunks[chunk_index - len(cached_entries)].append(chunks)
+        for chunk_index, cache_chunks in enumerate(new_cache_chunks, start=len(cached_entries)):
+            start = chunk_index * chunk_length
+            self.prefix_cache.put(keys[chunk_index], (outputs[:, start : start + chunk_length].clone(), cache_chunks))
+        logger.debug(f"Reused {cached_length} tokens from prefix cache, {len(self.prefix_cache)} chunks cached")
+        return outputs
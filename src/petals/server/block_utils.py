@@ -48,3 +48,13 @@ def get_block_size(
         bytes_per_value = torch.finfo(dtype).bits // 8
 
     return round(n_params * bytes_per_value * (1 + eps))
+
+
+def get_cache_bytes_per_token(config: PretrainedConfig, dtype: torch.dtype, cache_dtype: torch.dtype) -> float:
+    """Returns the attention cache size (keys and values) for one token in one block, in bytes"""
+    num_values = 2 * config.hidden_size // config.num_key_value_groups
+    if cache_dtype == torch.int8:
+        # int8 values + one scale per head (stored in the block dtype) for keys and values of each token
+        head_dim = config.hidden_size // config.num_attention_heads
+        return num_values * (1 + (torch.finfo(dtype).bits // 8) / head_dim)
+    return num_values * torch.finfo(cache_dtype).bits // 8
@@ -27,6 +27,8 @@ from petals.utils.hf_auth import always_needs_auth
 
 logger = get_logger(__name__)
 
+StateDict = Dict[str, torch.Tensor]
+
 
 def load_pretrained_block(
     model_name: str,
@@ -38,11 +40,15 @@ def load_pretrained_block(
     token: Optional[Union[str, bool]] = None,
     cache_dir: Optional[str] = None,
     max_disk_space: Optional[int] = None,
+    state_dict: Optional[StateDict] = None,
 ) -> nn.Module:
+    """
+    :param state_dict: block weights previously loaded with load_block_state_dict(); by default, load them here
+    :note: this function must not be called from multiple threads at once, since init_empty_weights() patches
+      torch.nn.Module globally. Use load_block_state_dict() to download and load weights in background threads.
+    """
     if config is None:
         config = AutoDistributedConfig.from_pretrained(model_name, use_auth_token=token)
-    if cache_dir is None:
-        cache_dir = DEFAULT_CACHE_DIR
 
     assert torch_dtype in DTYPE_MAP.values(), f"torch_dtype must be one of {list(DTYPE_MAP.values())}"
     torch_dtype = resolve_block_dtype(config, torch_dtype)
@@ -50,15 +56,16 @@ def load_pretrained_block(
     with init_empty_weights():
         block = config.block_class(config)
 
-    block_prefix = f"{config.block_prefix}.{block_index}."
-    state_dict = _load_state_dict_from_repo(
-        model_name,
-        block_prefix,
-        revision=revision,
-        token=token,
-        cache_dir=cache_dir,
-        max_disk_space=max_disk_space,
-    )
+    if state_dict is None:
+        state_dict = load_block_state_dict(
+            model_name,
+            block_index,
+            config=config,
+            revision=revision,
+            token=token,
+            cache_dir=cache_dir,
+            max_disk_space=max_disk_space,
+        )
 
     # dummy load, check that keys match
     report = block.load_state_dict(state_dict, strict=True)
@@ -75,7 +82,29 @@ def load_pretrained_block(
     return block
 
 
-StateDict = Dict[str, torch.Tensor]
+def load_block_state_dict(
+    model_name: str,
+    block_index: int,
+    *,
+    config: PretrainedConfig,
+    revision: Optional[str] = None,
+    token: Optional[Union[str, bool]] = None,
+    cache_dir: Optional[str] = None,
+    max_disk_space: Optional[int] = None,
+) -> StateDict:
+    """Download (if necessary) and load weights of a single block to CPU. Safe to call from multiple threads"""
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+
+    block_prefix = f"{config.block_prefix}.{block_index}."
+    return _load_state_dict_from_repo(
+        model_name,
+        block_prefix,
+        revision=revision,
+        token=token,
+        cache_dir=cache_dir,
+        max_disk_space=max_disk_space,
+    )
 
 
 def _load_state_dict_from_repo(
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import asyncio
 import contextlib
+import math
 import multiprocessing as mp
 import sys
 from enum import Enum
@@ -44,6 +45,7 @@ sys.modules["runtime_pb2"] = runtime_pb2
 
 
 CACHE_TOKENS_AVAILABLE = "cache_tokens_available"
+KV_CACHE_BLOCK_SIZE = 16  # attention caches are allocated (and grown) in blocks of this many tokens
 
 
 class Event(Enum):
@@ -165,9 +167,17 @@ class TransformerConnectionHandler(ConnectionHandler):
 
                 point_per_piece = points / max_length if max_length > 0 else 0.0
                 batch_size = request.tensors[0].size[0] if request.tensors else 1
+                first_shape = request.tensors[0].size if request.tensors else ()
+                first_length = first_shape[1] if len(first_shape) == 3 else 0
                 prefix_length = 0
 
-                async with self._allocate_cache(requested_backends, batch_size, max_length) as cache_handles:
+                # We reserve cache for max_length tokens in advance, so that a running session never fails because of
+                # other sessions. However, cache tensors start with the first step's tokens and grow in blocks as the
+                # session goes, so that memory reserved for tokens not generated yet is not occupied by zeros
+                cache_length = self._get_next_cache_length(0, first_length, max_length)
+                async with self._allocate_cache(
+                    requested_backends, batch_size, cache_length, max_length=max_length
+                ) as cache_handles:
                     assert len(cache_handles) == len(requested_backends)
                     first_request = request
                     background_tasks = set()
@@ -197,6 +207,11 @@ class TransformerConnectionHandler(ConnectionHandler):
                                 f"Maximum length exceeded: prefix {prefix_length} + current {length_increment}"
                                 f" exceeds pre-allocated maximum {max_length}"
                             )
+                        if prefix_length + length_increment > cache_length:
+                            cache_length = self._get_next_cache_length(
+                                cache_length, prefix_length + length_increment, max_length
+                            )
+                            await self._resize_cache(requested_backends, cache_handles, batch_size, cache_length)
 
                         priority = self._prioritizer.prioritize(
                             hidden_states,
@@ -567,16 +582,39 @@ class TransformerConnectionHandler(ConnectionHandler):
 
     @contextlib.asynccontextmanager
     async def _allocate_cache(
-        self, backends: Sequence[TransformerBackend], batch_size: int, max_length: int
+        self, backends: Sequence[TransformerBackend], batch_size: int, cache_length: int, *, max_length: int
     ) -> Sequence[Sequence[Handle]]:
         """
         Allocate memory cache for all transformer blocks, return cache handle
+        :param cache_length: allocate tensors for this many tokens now
+        :param max_length: reserve memory for this many tokens, so that _resize_cache up to max_length never fails
         :returns: a list of {len(backends)} elements, where i-th element is a tuple of cache handles for i-th backend
         """
-        descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
-        async with backends[0].memory_cache.allocate_cache(*chain(*descriptors)) as handles:
+        descriptors = [backend.get_inference_cache_descriptors(batch_size, cache_length) for backend in backends]
+        max_descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
+        async with backends[0].memory_cache.allocate_cache(
+            *chain(*descriptors), max_descriptors=tuple(chain(*max_descriptors))
+        ) as handles:
             yield nested_pack(handles, descriptors)
 
+    async def _resize_cache(
+        self,
+        backends: Sequence[TransformerBackend],
+        cache_handles: Sequence[Sequence[Handle]],
+        batch_size: int,
+        max_length: int,
+    ) -> None:
+        """Grow memory cache previously allocated with _allocate_cache to fit max_length tokens, keep cached values"""
+        descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
+        await backends[0].memory_cache.resize_cache(tuple(chain(*cache_handles)), *chain(*descriptors))
+
+    @staticmethod
+    def _get_next_cache_length(cache_length: int, required_length: int, max_length: int) -> int:
+        """Choose a new cache length that fits required_length tokens, rounded up to whole KV_CACHE_BLOCK_SIZE blocks"""
+        new_length = max(required_length, 2 * cache_length)  # grow at least 2x, so that copying is amortized
+        new_length = math.ceil(new_length / KV_CACHE_BLOCK_SIZE) * KV_CACHE_BLOCK_SIZE
+        return min(new_length, max_length)
+
     def _log_request(
         self,
         method: str,
@@ -644,28 +682,34 @@ async def _rpc_forward(
     hidden_states = hidden_states.to(dtype)
     assert hidden_states.ndim == 3
     if prompts is None or is_dummy(prompts):
-        prompts = [DUMMY] * len(requested_backends)
+        prompts = [None] * len(requested_backends)
     else:
         prompts = [p.squeeze(0) for p in prompts.to(requested_backends[0].dtype).split(1, dim=0)]
-
-    # Run a chain of requested backends
-    for backend, prompt in zip(requested_backends, prompts):
-        if not is_dummy(prompt):
-            hidden_states[:, : prompt.shape[1]] += prompt
-
-        assert isinstance(backend.inference_pool, PrioritizedTaskPool), "petals support only prioritized pools"
+        prompts = [prompt if not is_dummy(prompt) else None for prompt in prompts]
+
+    # Run a chain of requested backends in as few runtime calls as possible (forward pools are merged, see
+    # merge_forward_pools_inplace). Since the runtime can't interrupt a task, we limit the work per call to
+    # max_batch_size tokens x blocks, so that long forward passes don't delay latency-sensitive inference steps
+    assert isinstance(requested_backends[0].forward_pool, PrioritizedTaskPool), "petals support only prioritized pools"
+    num_tokens = hidden_states.shape[0] * hidden_states.shape[1]
+    max_blocks_per_call = max(1, requested_backends[0].forward_pool.max_batch_size // max(1, num_tokens))
+    for start in range(0, len(requested_backends), max_blocks_per_call):
+        requested_uids = tuple(backend.name for backend in requested_backends[start : start + max_blocks_per_call])
         priority = prioritizer.prioritize(
-            hidden_states, points=points / len(requested_backends), backend=backend, type="forward"
+            hidden_states,
+            points=points * len(requested_uids) / len(requested_backends),
+            requested_uids=requested_uids,
+            type="forward",
         )
-        (hidden_states,) = await backend.forward_pool.submit_task(
+        (hidden_states,) = await requested_backends[0].forward_pool.submit_task(
             hidden_states,
             active_adapter,
+            requested_uids,
+            *prompts[start : start + max_blocks_per_call],
             priority=priority,
         )
         assert isinstance(hidden_states, torch.Tensor)
-        assert (
-            hidden_states.ndim == 3
-        ), f"inputs to {type(backend)} must be a list with a single 3d tensor of hidden states"
+        assert hidden_states.ndim == 3, f"outputs of {requested_uids} must be a single 3d tensor of hidden states"
 
     return hidden_states
 
@@ -699,7 +743,9 @@ async def _rpc_backward(
         priority = prioritizer.prioritize(
             inputs, points=points / len(requested_backends), backend=backend, type="forward_in_backward"
         )
-        (inputs,) = await backend.forward_pool.submit_task(inputs, active_adapter, priority=priority)
+        (inputs,) = await backend.forward_pool.submit_task(
+            inputs, active_adapter, (backend.name,), None, priority=priority
+        )
 
         assert isinstance(inputs, torch.Tensor)
 
@@ -10,13 +10,15 @@ import ctypes
 import multiprocessing as mp
 import os
 import time
-from typing import AsyncContextManager, Dict, Optional, Sequence
+from collections import Counter, OrderedDict
+from typing import AsyncContextManager, Collection, Dict, Optional, Sequence, Tuple
 
 import hivemind
 import torch
 from hivemind.utils import TensorDescriptor, get_logger
 
 from petals.utils.asyncio import shield_and_wait
+from petals.utils.misc import get_dtype_size
 
 logger = get_logger(__name__)
 
@@ -26,13 +28,25 @@ Handle = int
 class MemoryCache:
     """A shared cache for storing tensors that persist across calls. Main use case: storing past attention KVs"""
 
-    def __init__(self, max_size_bytes: Optional[int], alloc_timeout: float):
-        self.max_size_bytes = max_size_bytes if max_size_bytes is not None else (2**64 - 1)
+    def __init__(self, max_size_bytes: Optional[int], alloc_timeout: float, max_offloaded_bytes: int = 0):
+        """
+        :param max_size_bytes: max total size of cached tensors on each device (unlimited if None)
+        :param alloc_timeout: wait at most this many seconds for the cache to have enough free space
+        :param max_offloaded_bytes: if positive, allow allocating this many extra bytes per device. Tensors that do not
+          fit into max_size_bytes are offloaded to (pinned) host memory while unused, least recently used first
+        """
+        assert max_offloaded_bytes == 0 or max_size_bytes is not None, "offloading requires a finite max_size_bytes"
+        self.max_device_size_bytes = max_size_bytes if max_size_bytes is not None else (2**64 - 1)
+        self.max_offloaded_bytes = max_offloaded_bytes
+        self.max_size_bytes = self.max_device_size_bytes + max_offloaded_bytes
         self.alloc_timeout = alloc_timeout
         self._lock_metadata = mp.Lock()
         self._current_size = mp.Value(ctypes.c_int64, 0, lock=False)
         self._handle_counter = mp.Value(ctypes.c_int64, 0, lock=False)
-        self._allocated_tensors: Dict[Handle, torch.Tensor] = {}
+        self._allocated_tensors: OrderedDict[Handle, torch.Tensor] = OrderedDict()  # from least to most recently used
+        self._size_by_device: Dict[torch.device, int] = Counter()  # only valid inside runtime
+        self._offloaded_from: Dict[Handle, torch.device] = {}  # only valid inside runtime
+        self._allocation_sizes: Dict[Tuple[Handle, ...], int] = {}  # only valid inside the allocating process
         self.runtime_pid = os.getpid()
 
         self._pipe_recv, self._pipe_send = mp.Pipe(duplex=False)  # any ConnectionHandler -> runtime
@@ -60,11 +74,15 @@ class MemoryCache:
         self._handle_counter.value = value
 
     @contextlib.asynccontextmanager
-    async def allocate_cache(self, *descriptors: TensorDescriptor) -> AsyncContextManager[Sequence[Handle]]:
+    async def allocate_cache(
+        self, *descriptors: TensorDescriptor, max_descriptors: Optional[Sequence[TensorDescriptor]] = None
+    ) -> AsyncContextManager[Sequence[Handle]]:
         """
         Create a handle that is associated with buffers on unique device. If cache full, raises AllocationFailed.
 
         :param descriptors: one or more tensors tensor of this size, dtype, etc
+        :param max_descriptors: if specified, reserve memory for these (larger) tensors in advance, so that growing
+          the tensors up to this size with resize_cache never waits for memory and never fails
 
         :note: if descriptors reside on different devices, it is expected that they are approximately balanced across devices;
           if not, it will count maximum tensor allocation across devices for the purposes of size limit
@@ -74,7 +92,7 @@ class MemoryCache:
         """
         assert os.getpid() != self.runtime_pid, "must be called by a ConnectionHandler, not runtime"
         assert all(descr.device is not None for descr in descriptors), "please specify allocated devices"
-        max_alloc_size = self.get_allocation_size(*descriptors)
+        max_alloc_size = self.get_allocation_size(*(max_descriptors if max_descriptors is not None else descriptors))
 
         gib = 1024**3
         cur_size, max_size = self.current_size_bytes, self.max_size_bytes
@@ -90,21 +108,50 @@ class MemoryCache:
             logger.info(f"rpc_inference.alloc(size={max_alloc_size / gib:.2f} GiB)")
             yield handles
         finally:
-            self._free(max_alloc_size, alloc_task)
+            self._free(alloc_task)
+
+    async def resize_cache(self, handles: Sequence[Handle], *descriptors: TensorDescriptor) -> None:
+        """
+        Grow tensors previously allocated with allocate_cache, keep their contents. If cache full, raises AllocationFailed.
+
+        :param handles: handles yielded by allocate_cache, in the same order
+        :param descriptors: new descriptors for these tensors, each must be at least as large as the old one in all dims
+
+        :note: This function should be called by the same ConnectionHandler that allocated these handles.
+        Memory beyond the size reserved in allocate_cache is counted towards the size limit; it is released together
+        with the original allocation.
+        """
+        assert os.getpid() != self.runtime_pid, "must be called by a ConnectionHandler, not runtime"
+        handles = tuple(handles)
+        assert len(handles) == len(descriptors), f"expected {len(handles)} descriptors, got {len(descriptors)}"
+        new_alloc_size = self.get_allocation_size(*descriptors)
+        extra_alloc_size = max(0, new_alloc_size - self._allocation_sizes[handles])
+        if extra_alloc_size == 0:  # the memory is already reserved, no need to wait for other sessions
+            with self._lock_metadata:
+                self._pipe_send.send((handles, descriptors))
+            return
+
+        gib = 1024**3
+        logger.debug(f"rpc_inference.resize(extra_size={extra_alloc_size / gib:.2f} GiB)")
+        await shield_and_wait(self._schedule_alloc(extra_alloc_size, *descriptors, handles=handles))
 
     @staticmethod
     def get_allocation_size(*descriptors: TensorDescriptor) -> int:
         """Return the memory size (bytes) to be allocated on a device. If there are many devices, return maximum"""
         alloc_size_by_device = {}
         for descr in descriptors:
-            tensor_size = descr.numel() * torch.finfo(descr.dtype).bits // 8
+            tensor_size = descr.numel() * get_dtype_size(descr.dtype)
             alloc_size_by_device[descr.device] = alloc_size_by_device.get(descr.device, 0) + tensor_size
         return max(alloc_size_by_device.values())
 
-    async def _schedule_alloc(self, alloc_size: int, *descriptors: TensorDescriptor) -> Sequence[Handle]:
+    async def _schedule_alloc(
+        self, alloc_size: int, *descriptors: TensorDescriptor, handles: Optional[Tuple[Handle, ...]] = None
+    ) -> Sequence[Handle]:
         """
         This method should be called inside asyncio.shield() because:
             - hivemind.utils.enter_asynchronously() does not always release the lock on cancellation
+
+        :param handles: if specified, resize tensors with these handles instead of creating new ones
         """
 
         loop = asyncio.get_event_loop()
@@ -112,20 +159,22 @@ class MemoryCache:
             if self.current_size_bytes + alloc_size > self.max_size_bytes:
                 await loop.run_in_executor(None, self._wait_until_available, alloc_size, self.alloc_timeout)
             with self._lock_metadata:
-                handles = tuple(int(self.handle_counter) + i for i in range(len(descriptors)))
+                if handles is None:
+                    handles = tuple(int(self.handle_counter) + i for i in range(len(descriptors)))
+                    self.handle_counter += len(handles)  # note: this will eventually overflow and it is okay
                 self.current_size_bytes += alloc_size
-                self.handle_counter += len(handles)  # note: this will eventually overflow and it is okay
+                self._allocation_sizes[handles] = self._allocation_sizes.get(handles, 0) + alloc_size
                 self._pipe_send.send((handles, descriptors))
                 return handles
 
-    def _free(self, alloc_size: int, alloc_task: asyncio.Task) -> None:
+    def _free(self, alloc_task: asyncio.Task) -> None:
         if alloc_task.exception() is not None:
             return
         handles = alloc_task.result()
 
         with self._lock_metadata:
             self._pipe_send.send((handles, None))  # signal runtime to free these handles
-            self.current_size_bytes -= alloc_size
+            self.current_size_bytes -= self._allocation_sizes.pop(handles)
         self._memory_freed_event.set()
 
     def _wait_until_available(self, allocated_size: int, timeout: Optional[float] = None):
@@ -157,20 +206,74 @@ class MemoryCache:
         # read creation/deletion requests from connection handlers
         while self._pipe_recv.poll():
             recv_handles, recv_data = self._pipe_recv.recv()
-            if recv_data is not None:  # create new tensors
+            if recv_data is not None:  # create new tensors or grow existing ones
                 assert len(recv_handles) == len(recv_data)
                 for handle, descr in zip(recv_handles, recv_data):
-                    self._allocated_tensors[handle] = descr.make_zeros()
-                    assert handle in self._allocated_tensors, f"Sanity check failed: no such handle ({handle})"
+                    old_tensor = self._set_tensor(handle, None)  # note: it may be offloaded, this is fine for copying
+                    self._offloaded_from.pop(handle, None)
+                    self._make_room(_get_device(descr), descr.numel() * get_dtype_size(descr.dtype), keep=handles)
+                    self._set_tensor(handle, descr.make_zeros())
+                    if old_tensor is not None:  # copy old contents into the leading slice of the new tensor
+                        self._allocated_tensors[handle][tuple(map(slice, old_tensor.shape))] = old_tensor
             else:  # delete tensors by handle
                 for handle in recv_handles:
                     if handle not in self._allocated_tensors:
                         logger.warning(
                             f"Sanity check failed: asked to delete handle {handle}, but there is no such handle"
                         )
-                    self._allocated_tensors.pop(handle, None)
+                    self._set_tensor(handle, None)
+                    self._offloaded_from.pop(handle, None)
+
+        for handle in handles:
+            if handle in self._offloaded_from:
+                self._fetch(handle, keep=handles)
+            self._allocated_tensors.move_to_end(handle)
         yield tuple(self._allocated_tensors[handle] for handle in handles)
 
+    def _set_tensor(self, handle: Handle, tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        """Replace (or delete, if tensor is None) the tensor for a given handle; return the old tensor, if any"""
+        old_tensor = self._allocated_tensors.pop(handle, None)
+        if old_tensor is not None:
+            self._size_by_device[old_tensor.device] -= old_tensor.numel() * old_tensor.element_size()
+        if tensor is not None:
+            self._allocated_tensors[handle] = tensor
+            self._size_by_device[tensor.device] += tensor.numel() * tensor.element_size()
+        return old_tensor
+
+    def _make_room(self, device: torch.device, size_bytes: int, keep: Collection[Handle]) -> None:
+        """Offload least recently used tensors until the device has size_bytes of free space (or nothing to offload)"""
+        if self.max_offloaded_bytes == 0 or device.type == "cpu":
+            return
+        for handle, tensor in list(self._allocated_tensors.items()):
+            if self._size_by_device[device] + size_bytes <= self.max_device_size_bytes:
+                break
+            if tensor.device == device and handle not in keep:
+                self._offload(handle)
+
+    def _offload(self, handle: Handle) -> None:
+        # note: copies are issued on the current stream, so they are ordered with respect to the compute that
+        # uses these tensors, while the runtime does not wait for them to finish
+        tensor = self._allocated_tensors[handle]
+        host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host_tensor.copy_(tensor, non_blocking=True)
+        self._offloaded_from[handle] = tensor.device
+        self._set_tensor(handle, host_tensor)
+        logger.debug(f"Offloaded cache handle {handle} to host memory")
+
+    def _fetch(self, handle: Handle, keep: Collection[Handle]) -> None:
+        device = self._offloaded_from.pop(handle)
+        host_tensor = self._allocated_tensors[handle]
+        self._make_room(device, host_tensor.numel() * host_tensor.element_size(), keep=keep)
+        self._set_tensor(handle, host_tensor.to(device, non_blocking=True))
+        logger.debug(f"Fetched cache handle {handle} from host memory")
+
+
+def _get_device(descr: TensorDescriptor) -> torch.device:
+    device = torch.device(descr.device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
 
 class AllocationFailed(Exception):
     pass
@@ -0,0 +1,65 @@
+"""
+A cache of attention keys/values for prompt prefixes that are shared by multiple inference sessions (e.g., system
+prompts or few-shot examples). Lives in the runtime process and is used by merged inference steps.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import torch
+from hivemind.utils.nested import nested_flatten
+
+
+class PrefixCache:
+    """
+    An LRU cache for results of processing prompt prefixes, split into chunks of {chunk_length} tokens.
+
+    Each chunk is keyed by a hash of all inputs up to and including this chunk, so sessions that share a prefix share
+    the entries for all of its chunks, like in a radix tree. The prefix itself is identified by input hidden states
+    (servers never see token ids), so it works for any blocks in the middle of the model as well.
+
+    :param max_size_bytes: max total size of cached tensors; least recently used chunks are evicted first
+    :param chunk_length: the number of tokens per chunk, only whole chunks are cached
+    """
+
+    def __init__(self, max_size_bytes: int, chunk_length: int = 16):
+        self.max_size_bytes, self.chunk_length = max_size_bytes, chunk_length
+        self.current_size_bytes = 0
+        self._entries: OrderedDict[bytes, Any] = OrderedDict()  # from least to most recently used
+        self._entry_sizes = {}
+
+    def get_keys(self, hidden_states: torch.Tensor, namespace: Any) -> List[bytes]:
+        """Compute keys for all whole chunks of hidden_states[batch_size, seq_length, hidden_size]"""
+        num_chunks = hidden_states.shape[1] // self.chunk_length
+        if num_chunks == 0:
+            return []
+        host_hidden_states = hidden_states[:, : num_chunks * self.chunk_length].cpu()
+        key = hashlib.blake2b(repr((namespace, tuple(hidden_states.shape[::2]), hidden_states.dtype)).encode()).digest()
+        keys = []
+        for start in range(0, num_chunks * self.chunk_length, self.chunk_length):
+            chunk = host_hidden_states[:, start : start + self.chunk_length].contiguous().view(torch.uint8)
+            key = hashlib.blake2b(key + chunk.numpy().tobytes()).digest()
+            keys.append(key)
+        return keys
+
+    def get(self, key: bytes) -> Optional[Any]:
+        """Return a nested structure of tensors stored for this key (or None if there is no such key)"""
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: bytes, value: Any) -> None:
+        """Store a nested structure of tensors for this key, evict least recently used entries if necessary"""
+        size = sum(tensor.numel() * tensor.element_size() for tensor in nested_flatten(value))
+        if key in self._entries or size > self.max_size_bytes:
+            return
+        while self.current_size_bytes + size > self.max_size_bytes:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self.current_size_bytes -= self._entry_sizes.pop(evicted_key)
+        self._entries[key] = value
+        self._entry_sizes[key] = size
+        self.current_size_bytes += size
+
+    def __len__(self):
+        return len(self._entries)
@@ -19,13 +19,18 @@ from petals.constants import REACHABILITY_API_URL
 logger = get_logger(__name__)
 
 
+def _check_reachability_once(peer_id) -> dict:
+    """ask the (centralized) validator if your peer is reachable, returns a dict with the "success" key and details"""
+    r = requests.get(f"{REACHABILITY_API_URL}/api/v1/is_reachable/{peer_id}", timeout=10)
+    r.raise_for_status()
+    return r.json()
+
+
 def validate_reachability(peer_id, wait_time: float = 7 * 60, retry_delay: float = 15) -> None:
     """verify that your peer is reachable from a (centralized) validator, whether directly or through a relay"""
     for attempt_no in range(math.floor(wait_time / retry_delay) + 1):
         try:
-            r = requests.get(f"{REACHABILITY_API_URL}/api/v1/is_reachable/{peer_id}", timeout=10)
-            r.raise_for_status()
-            response = r.json()
+            response = _check_reachability_once(peer_id)
 
             if response["success"]:
                 logger.info("Server is reachable from the Internet. It will appear at https://health.petals.dev soon")
@@ -52,6 +57,40 @@ def validate_reachability(peer_id, wait_time: float = 7 * 60, retry_delay: float
     )
 
 
+class BackgroundReachabilityCheck:
+    """
+    Polls the reachability API in a daemon thread without reporting failures, e.g. while the server loads blocks.
+    Call .finish() when the server is ready: it fails the same way as validate_reachability() if necessary
+    """
+
+    def __init__(self, peer_id, retry_delay: float = 15):
+        self.peer_id, self.retry_delay = peer_id, retry_delay
+        self.reachable, self._stop = threading.Event(), threading.Event()
+        threading.Thread(target=self._poll, name="check_reachability", daemon=True).start()
+
+    def _poll(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if _check_reachability_once(self.peer_id)["success"]:
+                    self.reachable.set()
+                    return
+            except Exception as e:
+                logger.debug(f"Background reachability check failed: {repr(e)}")
+                return  # validate_reachability() in .finish() will report this, if necessary
+            self._stop.wait(self.retry_delay)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def finish(self) -> None:
+        """Stop polling, then wait until the server is reachable (same as validate_reachability) unless it already is"""
+        self.stop()
+        if self.reachable.is_set():
+            logger.info("Server is reachable from the Internet. It will appear at https://health.petals.dev soon")
+        else:
+            validate_reachability(self.peer_id)
+
+
 def check_direct_reachability(max_peers: int = 5, threshold: float = 0.5, **kwargs) -> Optional[bool]:
     """test if your peer is accessible by others in the swarm with the specified network options in **kwargs"""
 
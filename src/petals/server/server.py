@@ -6,6 +6,9 @@ import multiprocessing as mp
 import random
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
 from typing import Dict, List, Optional, Sequence, Union
 
 import hivemind
@@ -22,12 +25,13 @@ from petals.constants import DTYPE_MAP, PUBLIC_INITIAL_PEERS
 from petals.data_structures import CHAIN_DELIMITER, UID_DELIMITER, ServerInfo, ServerState
 from petals.dht_utils import declare_active_modules, get_remote_module_infos
 from petals.server import block_selection
-from petals.server.backend import TransformerBackend, merge_inference_pools_inplace
-from petals.server.block_utils import get_block_size, resolve_block_dtype
-from petals.server.from_pretrained import load_pretrained_block
+from petals.server.backend import TransformerBackend, merge_forward_pools_inplace, merge_inference_pools_inplace
+from petals.server.block_utils import get_block_size, get_cache_bytes_per_token, resolve_block_dtype
+from petals.server.from_pretrained import load_block_state_dict, load_pretrained_block
 from petals.server.handler import TransformerConnectionHandler
 from petals.server.memory_cache import MemoryCache
-from petals.server.reachability import ReachabilityProtocol, check_direct_reachability, validate_reachability
+from petals.server.prefix_cache import PrefixCache
+from petals.server.reachability import BackgroundReachabilityCheck, ReachabilityProtocol, check_direct_reachability
 from petals.server.throughput import get_dtype_name, get_server_throughput
 from petals.utils.auto_config import AutoDistributedConfig
 from petals.utils.convert_block import QuantType, check_device_balance, convert_block
@@ -60,7 +64,10 @@ class Server:
         max_batch_size: Optional[int] = None,
         max_chunk_size_bytes: int = 256 * 1024 * 1024,
         attn_cache_tokens: Optional[int] = None,
+        attn_cache_offload_bytes: int = 0,
+        prefix_cache_tokens: int = 0,
         torch_dtype: str = "auto",
+        kv_cache_dtype: str = "auto",
         revision: Optional[str] = None,
         cache_dir: Optional[str] = None,
         max_disk_space: Optional[int] = None,
@@ -82,6 +89,7 @@ class Server:
         token: Optional[Union[str, bool]] = None,
         quant_type: Optional[QuantType] = None,
         tensor_parallel_devices: Optional[Sequence[torch.device]] = None,
+        torch_compile: bool = False,
         skip_reachability_check: bool = False,
         dht_client_mode: Optional[bool] = None,
         use_relay: bool = True,
@@ -144,12 +152,12 @@ class Server:
         )
         self.reachability_protocol = ReachabilityProtocol.attach_to_dht(self.dht) if not dht_client_mode else None
 
-        visible_maddrs_str = [str(a) for a in self.dht.get_visible_maddrs()]
         if initial_peers == PUBLIC_INITIAL_PEERS:
             logger.info("Connecting to the public swarm")
         else:
             logger.info(f"Connecting to a private swarm, initial peers: {initial_peers}")
-        logger.info(f"Running a server on {visible_maddrs_str}")
+        # Fetching visible maddrs requires a call to the DHT process, so we don't block the rest of startup on it
+        threading.Thread(target=self._log_visible_maddrs, name="log_visible_maddrs", daemon=True).start()
         self.should_validate_reachability = not skip_reachability_check and initial_peers == PUBLIC_INITIAL_PEERS
 
         if device is None:
@@ -162,6 +170,9 @@ class Server:
         torch_dtype = resolve_block_dtype(self.block_config, DTYPE_MAP[torch_dtype])
         self.torch_dtype = torch_dtype
 
+        assert kv_cache_dtype in ("auto", "int8"), f"Unsupported kv_cache_dtype: {kv_cache_dtype}"
+        self.cache_dtype = torch.int8 if kv_cache_dtype == "int8" else torch_dtype
+
         if tensor_parallel_devices is None:
             tensor_parallel_devices = (device,)
         self.tensor_parallel_devices = tuple(map(torch.device, tensor_parallel_devices))
@@ -177,6 +188,9 @@ class Server:
         self.quant_type = quant_type
         logger.info(f"Model weights are loaded in {get_dtype_name(torch_dtype, quant_type)} format")
 
+        assert not torch_compile or hasattr(torch, "compile"), "--torch_compile requires torch>=2.0"
+        self.torch_compile = torch_compile
+
         is_multiquery_attn = self.block_config.num_key_value_groups > 1
         if max_batch_size is None:
             max_batch_size = 8192 if is_multiquery_attn else 2048
@@ -189,9 +203,12 @@ class Server:
         # For attention cache in GPU or RAM
         if attn_cache_tokens is None:
             attn_cache_tokens = 32768 if is_multiquery_attn else 8192
-        cache_values_per_block = 2 * self.block_config.hidden_size * attn_cache_tokens
-        cache_values_per_block //= self.block_config.num_key_value_groups
-        self._cache_bytes_per_block = cache_values_per_block * torch.finfo(self.torch_dtype).bits // 8
+            if self.cache_dtype == torch.int8:
+                attn_cache_tokens *= 2  # int8 cache fits ~2x more tokens into the same memory
+        cache_bytes_per_token = get_cache_bytes_per_token(self.block_config, self.torch_dtype, self.cache_dtype)
+        self._cache_bytes_per_block = math.ceil(cache_bytes_per_token * attn_cache_tokens)
+        # For attention caches of prompt prefixes shared between sessions, stored in GPU
+        self._prefix_cache_bytes_per_block = math.ceil(cache_bytes_per_token * prefix_cache_tokens)
 
         # For disk cache
         self.cache_dir = cache_dir
@@ -214,6 +231,14 @@ class Server:
         gib = 1024**3
         self.attn_cache_bytes = self._cache_bytes_per_block * num_blocks
         logger.info(f"Attention cache for all blocks will consume up to {self.attn_cache_bytes / gib:.2f} GiB")
+        if attn_cache_offload_bytes > 0 and self.device.type != "cuda":
+            raise ValueError("--attn_cache_offload_size is only supported for CUDA devices")
+        self.attn_cache_offload_bytes = attn_cache_offload_bytes
+        if attn_cache_offload_bytes > 0:
+            logger.info(f"Up to {attn_cache_offload_bytes / gib:.2f} GiB of attention cache may be offloaded to RAM")
+        self.prefix_cache_bytes = self._prefix_cache_bytes_per_block * num_blocks
+        if self.prefix_cache_bytes > 0:
+            logger.info(f"Prefix cache for all blocks will consume up to {self.prefix_cache_bytes / gib:.2f} GiB")
 
         self.alloc_timeout = alloc_timeout
 
@@ -249,6 +274,10 @@ class Server:
 
         self.stop = threading.Event()
 
+    def _log_visible_maddrs(self) -> None:
+        visible_maddrs_str = [str(a) for a in self.dht.get_visible_maddrs()]
+        logger.info(f"Running a server on {visible_maddrs_str}")
+
     def _choose_num_blocks(self) -> int:
         assert self.device.type == "cuda", (
             "GPU is not available. If you want to run a CPU-only server, please specify --num_blocks. "
@@ -275,7 +304,7 @@ class Server:
         autograd_memory = 2 * gib * num_devices / 14336 * self.block_config.hidden_size
 
         block_size = get_block_size(self.block_config, "memory", dtype=self.torch_dtype, quant_type=self.quant_type)
-        total_memory_per_block = block_size + self._cache_bytes_per_block
+        total_memory_per_block = block_size + self._cache_bytes_per_block + self._prefix_cache_bytes_per_block
         if self.adapters:
             # Delay import of petals.utils.peft to avoid unnecessary import of bitsandbytes
             from petals.utils.peft import estimate_adapter_memory_per_block
@@ -308,6 +337,8 @@ class Server:
                 converted_model_name_or_path=self.converted_model_name_or_path,
                 block_config=self.block_config,
                 attn_cache_bytes=self.attn_cache_bytes,
+                attn_cache_offload_bytes=self.attn_cache_offload_bytes,
+                prefix_cache_bytes=self.prefix_cache_bytes,
                 alloc_timeout=self.alloc_timeout,
                 server_info=self.server_info,
                 block_indices=block_indices,
@@ -317,6 +348,7 @@ class Server:
                 max_chunk_size_bytes=self.max_chunk_size_bytes,
                 inference_max_length=self.inference_max_length,
                 torch_dtype=self.torch_dtype,
+                cache_dtype=self.cache_dtype,
                 cache_dir=self.cache_dir,
                 max_disk_space=self.max_disk_space,
                 device=self.device,
@@ -333,6 +365,7 @@ class Server:
                 token=self.token,
                 quant_type=self.quant_type,
                 tensor_parallel_devices=self.tensor_parallel_devices,
+                torch_compile=self.torch_compile,
                 should_validate_reachability=self.should_validate_reachability,
                 start=True,
             )
@@ -410,6 +443,8 @@ class ModuleContainer(threading.Thread):
         converted_model_name_or_path: str,
         block_config: PretrainedConfig,
         attn_cache_bytes: int,
+        attn_cache_offload_bytes: int,
+        prefix_cache_bytes: int,
         alloc_timeout: float,
         server_info: ServerInfo,
         block_indices: List[int],
@@ -417,6 +452,7 @@ class ModuleContainer(threading.Thread):
         max_batch_size: int,
         max_chunk_size_bytes: int,
         torch_dtype: torch.dtype,
+        cache_dtype: torch.dtype,
         cache_dir: str,
         max_disk_space: int,
         device: Union[str, torch.device],
@@ -427,11 +463,13 @@ class ModuleContainer(threading.Thread):
         token: Optional[Union[str, bool]],
         quant_type: QuantType,
         tensor_parallel_devices: Sequence[torch.device],
+        torch_compile: bool,
         should_validate_reachability: bool,
+        max_prefetched_blocks: int = 2,
         **kwargs,
     ) -> ModuleContainer:
         module_uids = [f"{dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
-        memory_cache = MemoryCache(attn_cache_bytes, alloc_timeout)
+        memory_cache = MemoryCache(attn_cache_bytes, alloc_timeout, max_offloaded_bytes=attn_cache_offload_bytes)
 
         server_info.state = ServerState.JOINING
         dht_announcer = ModuleAnnouncerThread(
@@ -440,6 +478,7 @@ class ModuleContainer(threading.Thread):
             server_info,
             block_config=block_config,
             memory_cache=memory_cache,
+            cache_dtype=cache_dtype,
             update_period=update_period,
             expiration=expiration,
             daemon=True,
@@ -448,10 +487,47 @@ class ModuleContainer(threading.Thread):
         logger.info(f"Announced that blocks {block_indices} are joining")
 
         assert len(tensor_parallel_devices) >= 1 and all(isinstance(d, torch.device) for d in tensor_parallel_devices)
+        if torch_compile:
+            from torch import _dynamo  # not "import torch._dynamo", since it would make torch a local name here
+
+            # All blocks share the same forward code, and each of them has separate graphs for forward, backward,
+            # prefill and decoding steps (with batch size 1 and larger), so we don't want dynamo to give up on them
+            num_graphs = 8 * len(block_indices)
+            _dynamo.config.cache_size_limit = max(_dynamo.config.cache_size_limit, num_graphs)
+            if hasattr(_dynamo.config, "accumulated_cache_size_limit"):  # torch>=2.2 also limits the total count
+                limit = max(_dynamo.config.accumulated_cache_size_limit, num_graphs)
+                _dynamo.config.accumulated_cache_size_limit = limit
+
+        # Poll reachability while loading blocks, so that we don't need to wait for it afterwards if it is fine.
+        # We only report errors after loading, since libp2p may need this time to set up relays (if we're behind NAT)
+        reachability_check = BackgroundReachabilityCheck(dht.peer_id) if should_validate_reachability else None
 
         blocks = {}
+        # Download and load weights of the next blocks in background threads while converting the current one.
+        # We limit the number of prefetched blocks since each of them is held in RAM until it is converted
+        load_state_dict = partial(
+            load_block_state_dict,
+            converted_model_name_or_path,
+            config=block_config,
+            revision=revision,
+            token=token,
+            cache_dir=cache_dir,
+            max_disk_space=max_disk_space,
+        )
+        prefetched_state_dicts = deque(
+            _run_in_daemon_thread(load_state_dict, block_index) for block_index in block_indices[:max_prefetched_blocks]
+        )
+        # hidden states are [batch_size, seq_length, hidden_size], with batch size and sequence length set per request
+        hidden_states_schema = BatchTensorDescriptor(
+            None, block_config.hidden_size, dtype=torch_dtype, compression=compression
+        )
         try:
-            for module_uid, block_index in zip(module_uids, block_indices):
+            for i, (module_uid, block_index) in enumerate(zip(module_uids, block_indices)):
+                state_dict = prefetched_state_dicts.popleft().result()
+                if i + max_prefetched_blocks < len(block_indices):
+                    next_block_index = block_indices[i + max_prefetched_blocks]
+                    prefetched_state_dicts.append(_run_in_daemon_thread(load_state_dict, next_block_index))
+
                 block = load_pretrained_block(
                     converted_model_name_or_path,
                     block_index,
@@ -461,7 +537,9 @@ class ModuleContainer(threading.Thread):
                     token=token,
                     cache_dir=cache_dir,
                     max_disk_space=max_disk_space,
+                    state_dict=state_dict,
                 )
+                del state_dict  # do not keep CPU copies of the weights after the block is moved to its device
                 block = convert_block(
                     block,
                     block_index,
@@ -475,32 +553,32 @@ class ModuleContainer(threading.Thread):
                     cache_dir=cache_dir,
                     max_disk_space=max_disk_space,
                 )
+                if torch_compile:
+                    for shard in block.module_shards:
+                        shard.forward = torch.compile(shard.forward, dynamic=True)
                 blocks[module_uid] = TransformerBackend(
                     module_uid,
                     block,
                     config=block_config,
                     memory_cache=memory_cache,
                     backend_dtype=torch_dtype,
+                    cache_dtype=cache_dtype,
                     max_chunk_size_bytes=max_chunk_size_bytes,
-                    args_schema=(
-                        BatchTensorDescriptor(
-                            1, 2048, block_config.hidden_size, dtype=torch_dtype, compression=compression
-                        ),
-                    ),
+                    args_schema=(hidden_states_schema,),
                     kwargs_schema={},
-                    outputs_schema=(
-                        BatchTensorDescriptor(
-                            1, 2048, block_config.hidden_size, dtype=torch_dtype, compression=compression
-                        ),
-                    ),
+                    outputs_schema=(hidden_states_schema,),
                     min_batch_size=min_batch_size,
                     max_batch_size=max_batch_size,
                 )
+                if torch_compile:
+                    blocks[module_uid].warmup()  # compile now, so that the first requests do not time out
 
-            merge_inference_pools_inplace(blocks)
+            prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+            merge_inference_pools_inplace(blocks, prefix_cache=prefix_cache)
+            merge_forward_pools_inplace(blocks)
 
-            if should_validate_reachability:
-                validate_reachability(dht.peer_id)
+            if reachability_check is not None:
+                reachability_check.finish()
         except:
             logger.debug("Shutting down backends")
             for backend in blocks.values():
@@ -509,6 +587,11 @@ class ModuleContainer(threading.Thread):
             dht_announcer.announce(ServerState.OFFLINE)
             logger.info(f"Announced that blocks {module_uids} are offline")
             raise
+        finally:
+            # All prefetched blocks are consumed if loading succeeded. Otherwise (e.g., on a loading error or Ctrl+C),
+            # we don't wait for the running downloads: they are daemon threads, so they don't block the process exit
+            if reachability_check is not None:
+                reachability_check.stop()
 
         return cls(
             dht,
@@ -575,8 +658,11 @@ class ModuleContainer(threading.Thread):
         Runs ModuleContainer in the current thread. Initializes dht if necessary, starts connection handlers,
         runs Runtime (self.runtime) to process incoming requests.
         """
+        # Start all handlers before waiting for any of them, so that they connect to the DHT concurrently
         for handler in self.conn_handlers:
-            handler.run_in_background()
+            handler.run_in_background(await_ready=False)
+        for handler in self.conn_handlers:
+            handler.ready.result()
 
         self.runtime.run()
 
@@ -648,6 +734,7 @@ class ModuleAnnouncerThread(threading.Thread):
         *,
         block_config: PretrainedConfig,
         memory_cache: MemoryCache,
+        cache_dtype: torch.dtype,
         update_period: float,
         expiration: float,
         max_pinged: int = 5,
@@ -659,8 +746,9 @@ class ModuleAnnouncerThread(threading.Thread):
         self.server_info = server_info
         self.memory_cache = memory_cache
 
-        self.bytes_per_token = block_config.hidden_size * torch.finfo(DTYPE_MAP[server_info.torch_dtype]).bits // 8
-        self.bytes_per_token //= block_config.num_key_value_groups
+        # Note: here, keys and values of each token are counted as two separate tokens
+        torch_dtype = DTYPE_MAP[server_info.torch_dtype]
+        self.bytes_per_token = get_cache_bytes_per_token(block_config, torch_dtype, cache_dtype) / 2
 
         self.update_period = update_period
         self.expiration = expiration
@@ -677,7 +765,7 @@ class ModuleAnnouncerThread(threading.Thread):
         while True:
             start_time = time.perf_counter()
 
-            self.server_info.cache_tokens_left = self.memory_cache.bytes_left // self.bytes_per_token
+            self.server_info.cache_tokens_left = int(self.memory_cache.bytes_left // self.bytes_per_token)
             if self.server_info.state != ServerState.OFFLINE:
                 self._ping_next_servers()
                 self.server_info.next_pings = {
@@ -724,3 +812,22 @@ class RuntimeWithDeduplicatedPools(Runtime):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.pools = tuple(set(self.pools))
+
+
+def _run_in_daemon_thread(func, *args) -> Future:
+    """
+    Run func(*args) in a new daemon thread and return a future for its result.
+    Unlike ThreadPoolExecutor, this doesn't make the process wait for the thread at exit.
+    """
+    future = Future()
+
+    def _target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_target, daemon=True).start()
+    return future
@@ -5,3 +5,8 @@ DUMMY = torch.empty(0)  # dummy tensor that replaces empty prompt or adapter par
 
 def is_dummy(tensor: torch.Tensor):
     return tensor.numel() == 0
+
+
+def get_dtype_size(dtype: torch.dtype) -> int:
+    """Returns the number of bytes used to store one value of this dtype"""
+    return torch.empty((), dtype=dtype).element_size()
@@ -0,0 +1,127 @@
+import asyncio
+import contextlib
+import multiprocessing as mp
+
+import pytest
+import torch
+from hivemind.utils import TensorDescriptor
+
+from petals.server.memory_cache import AllocationFailed, MemoryCache
+
+
+@pytest.mark.forked
+def test_cache_resize():
+    cache = MemoryCache(max_size_bytes=1024, alloc_timeout=1)
+    small_descr = TensorDescriptor((2, 4), dtype=torch.float32, device=torch.device("cpu"))
+    large_descr = TensorDescriptor((3, 6), dtype=torch.float32, device=torch.device("cpu"))
+    reference = torch.arange(8, dtype=torch.float32).reshape(2, 4)
+
+    pipe_recv, pipe_send = mp.Pipe(duplex=False)
+    values_written, resized, done = mp.Event(), mp.Event(), mp.Event()
+
+    async def _allocate_and_resize():
+        async with cache.allocate_cache(small_descr) as handles:
+            assert cache.current_size_bytes == 2 * 4 * 4
+            pipe_send.send(handles)
+            values_written.wait()
+
+            await cache.resize_cache(handles, large_descr)
+            assert cache.current_size_bytes == 3 * 6 * 4
+            resized.set()
+            done.wait()
+        assert cache.current_size_bytes == 0
+
+    proc = mp.Process(target=lambda: asyncio.run(_allocate_and_resize()))
+    proc.start()
+
+    (handle,) = pipe_recv.recv()
+    with cache.use_cache(handle) as (tensor,):
+        assert tensor.shape == (2, 4)
+        tensor[...] = reference
+    values_written.set()
+
+    assert resized.wait(timeout=10)
+    with cache.use_cache(handle) as (tensor,):
+        assert tensor.shape == (3, 6)
+        assert torch.equal(tensor[:2, :4], reference)
+        assert torch.all(tensor[2:] == 0) and torch.all(tensor[:, 4:] == 0)
+    done.set()
+
+    proc.join(timeout=10)
+    assert proc.exitcode == 0
+
+
+@pytest.mark.forked
+def test_cache_reserve():
+    cache = MemoryCache(max_size_bytes=1024, alloc_timeout=1)
+    small_descr = TensorDescriptor((2, 4), dtype=torch.float32, device=torch.device("cpu"))
+    large_descr = TensorDescriptor((3, 6), dtype=torch.float32, device=torch.device("cpu"))
+    huge_descr = TensorDescriptor((16, 16), dtype=torch.float32, device=torch.device("cpu"))
+
+    async def _allocate_and_resize():
+        async with cache.allocate_cache(small_descr, max_descriptors=(large_descr,)) as handles:
+            assert cache.current_size_bytes == 3 * 6 * 4  # memory for large_descr is reserved in advance
+            await cache.resize_cache(handles, large_descr)
+            assert cache.current_size_bytes == 3 * 6 * 4
+
+            # other sessions can't take the reserved memory away
+            with pytest.raises(AllocationFailed):
+                async with cache.allocate_cache(huge_descr):
+                    pass
+        assert cache.current_size_bytes == 0
+
+    proc = mp.Process(target=lambda: asyncio.run(_allocate_and_resize()))
+    proc.start()
+    proc.join(timeout=10)
+    assert proc.exitcode == 0
+
+
+@pytest.mark.forked
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="offloading is only supported for CUDA devices")
+def test_cache_offload():
+    device = torch.device("cuda:0")
+    cache = MemoryCache(max_size_bytes=2 * 1024 * 4, alloc_timeout=1, max_offloaded_bytes=2 * 1024 * 4)
+    descr = TensorDescriptor((1024,), dtype=torch.float32, device=device)
+    large_descr = TensorDescriptor((1536,), dtype=torch.float32, device=device)
+
+    pipe_recv, pipe_send = mp.Pipe(duplex=False)
+    resize_requested, resized, done = mp.Event(), mp.Event(), mp.Event()
+
+    async def _allocate_and_resize():
+        async with contextlib.AsyncExitStack() as stack:
+            handles = [await stack.enter_async_context(cache.allocate_cache(descr)) for _ in range(3)]
+            pipe_send.send([handle for (handle,) in handles])  # device budget fits only 2 of them
+            resize_requested.wait()
+            await cache.resize_cache(handles[1], large_descr)
+            resized.set()
+            done.wait()
+
+    proc = mp.Process(target=lambda: asyncio.run(_allocate_and_resize()))
+    proc.start()
+
+    handles = pipe_recv.recv()
+    for value, handle in enumerate(handles):
+        with cache.use_cache(handle) as (tensor,):
+            assert tensor.device == device
+            tensor.fill_(value)
+        assert cache._size_by_device[device] <= cache.max_device_size_bytes
+    assert cache._allocated_tensors[handles[0]].device.type == "cpu"  # the least recently used tensor is offloaded
+
+    with cache.use_cache(handles[0]) as (tensor,):
+        assert tensor.device == device and torch.all(tensor == 0)
+    assert cache._allocated_tensors[handles[1]].device.type == "cpu"
+
+    resize_requested.set()  # resize a tensor while it is offloaded
+    assert resized.wait(timeout=10)
+    with cache.use_cache(handles[1]) as (tensor,):
+        assert tensor.shape == (1536,) and tensor.device == device
+        assert torch.all(tensor[:1024] == 1) and torch.all(tensor[1024:] == 0)
+    assert cache._size_by_device[device] <= cache.max_device_size_bytes
+
+    with cache.use_cache(handles[2]) as (tensor,):
+        assert tensor.device == device and torch.all(tensor == 2)
+    assert cache._size_by_device[device] <= cache.max_device_size_bytes
+    done.set()
+
+    proc.join(timeout=10)
+    assert proc.exitcode == 0
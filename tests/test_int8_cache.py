@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from petals.server.backend import _quantize_int8
+from petals.server.block_utils import get_cache_bytes_per_token
+from petals.server.memory_cache import MemoryCache
+from test_utils import make_backend
+
+
+@pytest.mark.parametrize("dim", [2, 3])
+def test_quantize_int8(dim: int):
+    tensor = torch.randn(2, 3, 8, 5) * torch.rand(2, 3, 8, 5) * 10
+    values, scales = _quantize_int8(tensor, dim=dim)
+    assert values.dtype == torch.int8 and values.shape == tensor.shape
+    assert scales.dtype == tensor.dtype
+    assert scales.shape == tuple(1 if i == dim else size for i, size in enumerate(tensor.shape))  # one scale per slice
+    assert torch.all(values.abs() <= 127)
+    assert torch.all((values * scales - tensor).abs() <= scales / 2 + 1e-5)
+
+    values, scales = _quantize_int8(torch.zeros(2, 3), dim=1)
+    assert torch.all(values == 0) and torch.all(torch.isfinite(scales))
+
+
+@pytest.mark.forked
+def test_int8_cache_roundtrip(batch_size: int = 2, seq_length: int = 8):
+    backend = make_backend(0, MemoryCache(max_size_bytes=None, alloc_timeout=1), cache_dtype=torch.int8)
+    config = backend.config
+
+    bytes_per_token = get_cache_bytes_per_token(config, torch.float32, torch.int8)
+    assert backend.cache_bytes_per_token[torch.device("cpu")] == bytes_per_token
+    assert bytes_per_token < get_cache_bytes_per_token(config, torch.float32, torch.float32) / 3
+
+    kv_descr, scales_descr = backend.get_inference_cache_descriptors(batch_size, seq_length)
+    assert kv_descr.dtype == torch.int8 and scales_descr.dtype == torch.float32
+    assert scales_descr.shape == (*kv_descr.shape[:-1], 1)
+
+    cache_tensors = [kv_descr.make_zeros(), scales_descr.make_zeros()]
+    hidden_states = torch.randn(batch_size, seq_length, config.hidden_size)
+    with torch.inference_mode():
+        layer_past = backend._select_layer_past(cache_tensors, 0)
+        _, new_kvs = backend.module.forward(hidden_states, layer_past=layer_past, use_cache=True)
+        backend._update_cache_inplace(cache_tensors, new_kvs, 0)
+        restored_kvs = backend._select_layer_past(cache_tensors, seq_length)
+
+    for new_kv, restored_kv in zip(new_kvs, restored_kvs):
+        assert restored_kv.shape == new_kv.shape and restored_kv.dtype == torch.float32
+        assert torch.allclose(restored_kv, new_kv, rtol=0, atol=new_kv.abs().max().item() / 127)
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+import torch
+
+from petals.server.backend import _MergedForwardStep, merge_forward_pools_inplace
+from petals.server.handler import _rpc_forward
+from petals.server.memory_cache import MemoryCache
+from petals.server.server import RuntimeWithDeduplicatedPools
+from petals.server.task_prioritizer import DummyTaskPrioritizer
+from petals.utils.misc import DUMMY
+from test_utils import make_backend
+
+
+def _forward_sequentially(backends, hidden_states, prompts):
+    hidden_states = hidden_states.clone()
+    for backend, prompt in zip(backends, prompts):
+        if prompt is not None:
+            hidden_states[:, : prompt.shape[1]] += prompt
+        (hidden_states,) = backend.forward(hidden_states, "")
+    return hidden_states
+
+
+@pytest.mark.forked
+def test_merged_forward_step(num_blocks: int = 3, batch_size: int = 2, seq_length: int = 5):
+    memory_cache = MemoryCache(max_size_bytes=None, alloc_timeout=1)
+    backends = {f"block.{i}": make_backend(i, memory_cache) for i in range(num_blocks)}
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    step = _MergedForwardStep(backends)
+
+    hidden_states = torch.randn(batch_size, seq_length, hidden_size)
+    prompt = torch.randn(batch_size, 2, hidden_size)
+    for prompts in [[None] * num_blocks, [prompt, None, prompt]]:
+        (outputs,) = step(hidden_states.clone(), "", tuple(backends), *prompts)
+        reference = _forward_sequentially(backends.values(), hidden_states, prompts)
+        assert torch.allclose(outputs, reference, atol=1e-5)
+
+    # rpc_backward runs one block per call to collect intermediate inputs
+    (outputs,) = step(hidden_states.clone(), "", ("block.1",), None)
+    assert torch.allclose(outputs, _forward_sequentially([backends["block.1"]], hidden_states, [None]), atol=1e-5)
+
+
+@pytest.mark.forked
+def test_rpc_forward_splits_blocks(num_blocks: int = 3, batch_size: int = 1, seq_length: int = 4):
+    memory_cache = MemoryCache(max_size_bytes=None, alloc_timeout=1)
+    backends = {f"block.{i}": make_backend(i, memory_cache) for i in range(num_blocks)}
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    merge_forward_pools_inplace(backends)
+
+    pool = next(iter(backends.values())).forward_pool
+    pool.max_batch_size = 2 * batch_size * seq_length  # fits 2 blocks per runtime call
+    merged_step, requested_uids = pool.process_func, []
+
+    def _process_and_record_uids(*args):
+        requested_uids.append(args[2])
+        return merged_step(*args)
+
+    pool.process_func = _process_and_record_uids
+
+    hidden_states = torch.randn(batch_size, seq_length, hidden_size)
+    prompts = torch.randn(num_blocks, batch_size, 2, hidden_size)
+    runtime = RuntimeWithDeduplicatedPools(backends, device=None)
+    runtime.run_in_background(await_ready=True)
+    try:
+        for flat_prompts, reference_prompts in [(DUMMY, [None] * num_blocks), (prompts, list(prompts))]:
+            requested_uids.clear()
+            outputs = asyncio.run(
+                _rpc_forward(
+                    hidden_states.clone(),
+                    flat_prompts,
+                    requested_backends=list(backends.values()),
+                    prioritizer=DummyTaskPrioritizer(),
+                )
+            )
+            assert requested_uids == [("block.0", "block.1"), ("block.2",)]
+            reference = _forward_sequentially(backends.values(), hidden_states, reference_prompts)
+            assert torch.allclose(outputs, reference, atol=1e-5)
+    finally:
+        runtime.shutdown()
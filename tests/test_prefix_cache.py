@@ -0,0 +1,113 @@
+import asyncio
+import contextlib
+import multiprocessing as mp
+from itertools import chain
+
+import pytest
+import torch
+from hivemind.utils.nested import nested_pack
+
+from petals.data_structures import InferenceMetadata
+from petals.server.backend import TransformerBackend, _MergedInferenceStep
+from petals.server.memory_cache import MemoryCache
+from petals.server.prefix_cache import PrefixCache
+from petals.utils.misc import DUMMY
+from test_utils import make_backend
+
+
+def test_prefix_cache_keys():
+    cache = PrefixCache(max_size_bytes=1024, chunk_length=4)
+    hidden_states = torch.randn(1, 10, 8)
+    keys = cache.get_keys(hidden_states, namespace="block0")
+    assert len(keys) == 2 and len(set(keys)) == 2
+
+    other_suffix = torch.cat([hidden_states[:, :4], torch.randn(1, 6, 8)], dim=1)
+    other_keys = cache.get_keys(other_suffix, namespace="block0")
+    assert other_keys[0] == keys[0] and other_keys[1] != keys[1]
+
+    assert cache.get_keys(hidden_states, namespace="block1")[0] != keys[0]
+    assert cache.get_keys(hidden_states[:, :3], namespace="block0") == []
+
+
+def test_prefix_cache_eviction():
+    cache = PrefixCache(max_size_bytes=3 * 16 * 4, chunk_length=4)
+    for i in range(3):
+        cache.put(b"key%d" % i, (torch.full((16,), i, dtype=torch.float32), []))
+    assert len(cache) == 3 and cache.current_size_bytes == 3 * 16 * 4
+
+    assert cache.get(b"key0") is not None  # now key1 is the least recently used
+    cache.put(b"key3", (torch.zeros(16), [(torch.zeros(4), torch.zeros(4))]))
+    assert cache.get(b"key1") is None and cache.get(b"key2") is None
+    assert torch.equal(cache.get(b"key0")[0], torch.zeros(16))
+    assert cache.current_size_bytes <= cache.max_size_bytes
+
+    cache.put(b"huge", (torch.zeros(1024),))
+    assert cache.get(b"huge") is None
+
+
+def test_read_write_cache():
+    cache_tensors = [torch.randn(2, 3, 4, 20, 8), torch.randn(2, 3, 4, 20, 1)]  # keys/values and their scales
+    chunks = TransformerBackend.read_cache(cache_tensors, 4, 12)
+    assert [chunk.shape for chunk in chunks] == [(2, 3, 4, 8, 8), (2, 3, 4, 8, 1)]
+    assert chunks[0].data_ptr() != cache_tensors[0].data_ptr()  # read_cache returns copies
+
+    new_cache_tensors = [torch.zeros_like(tensor) for tensor in cache_tensors]
+    TransformerBackend.write_cache(new_cache_tensors, chunks, start=4)
+    for tensor, new_tensor in zip(cache_tensors, new_cache_tensors):
+        assert torch.equal(new_tensor[:, :, :, 4:12], tensor[:, :, :, 4:12])
+        assert torch.all(new_tensor[:, :, :, :4] == 0) and torch.all(new_tensor[:, :, :, 12:] == 0)
+
+
+@pytest.mark.forked
+def test_inference_step_with_prefix_cache(num_blocks: int = 2, max_length: int = 32):
+    memory_cache = MemoryCache(max_size_bytes=None, alloc_timeout=1)
+    backends = {f"block.{i}": make_backend(i, memory_cache) for i in range(num_blocks)}
+    config = next(iter(backends.values())).config
+    descriptors = [backend.get_inference_cache_descriptors(1, max_length) for backend in backends.values()]
+
+    num_sessions = 3
+    pipe_recv, pipe_send = mp.Pipe(duplex=False)
+    done = mp.Event()
+
+    async def _allocate_sessions():
+        async with contextlib.AsyncExitStack() as stack:
+            for _ in range(num_sessions):
+                handles = await stack.enter_async_context(memory_cache.allocate_cache(*chain(*descriptors)))
+                pipe_send.send(nested_pack(handles, descriptors))
+            done.wait()
+
+    proc = mp.Process(target=lambda: asyncio.run(_allocate_sessions()))
+    proc.start()
+    sessions = [pipe_recv.recv() for _ in range(num_sessions)]
+
+    step = _MergedInferenceStep(backends, PrefixCache(max_size_bytes=2**30, chunk_length=16))
+
+    def _first_step(cache_handles, hidden_states):
+        infos = [InferenceMetadata(uid, 0, tuple(handles), "") for uid, handles in zip(backends, cache_handles)]
+        (outputs,) = step(hidden_states.clone(), DUMMY, infos, *([None] * len(infos)))
+        return outputs
+
+    def _read_session_cache(cache_handles, length):
+        cache = []
+        for backend, handles in zip(backends.values(), cache_handles):
+            with memory_cache.use_cache(*handles) as cache_tensors:
+                cache.extend(backend.read_cache(cache_tensors, 0, length))
+        return cache
+
+    inputs = torch.randn(1, 20, config.hidden_size)
+    outputs_cold = _first_step(sessions[0], inputs)  # computes everything, caches the first 16 tokens
+    assert len(step.prefix_cache) == 1
+
+    outputs_hit = _first_step(sessions[1], inputs)  # reuses the first 16 tokens, computes the other 4
+    assert torch.allclose(outputs_hit, outputs_cold, atol=1e-5)
+    for cache_hit, cache_cold in zip(_read_session_cache(sessions[1], 20), _read_session_cache(sessions[0], 20)):
+        assert torch.allclose(cache_hit, cache_cold, atol=1e-5)
+
+    outputs_full_hit = _first_step(sessions[2], inputs[:, :16])  # reuses all tokens
+    assert torch.allclose(outputs_full_hit, outputs_cold[:, :16], atol=1e-5)
+    outputs_full_hit += 1  # outputs may be modified in-place when sent to the client, this must not affect the cache
+    assert torch.allclose(_first_step(sessions[2], inputs[:, :16]), outputs_cold[:, :16], atol=1e-5)
+
+    done.set()
+    proc.join(timeout=10)
+    assert proc.exitcode == 0
@@ -1,4 +1,14 @@
 import os
+from typing import Optional
+
+import torch
+from hivemind import BatchTensorDescriptor
+
+from petals.server.backend import TransformerBackend
+from petals.server.from_pretrained import load_pretrained_block
+from petals.server.memory_cache import MemoryCache
+from petals.utils.auto_config import AutoDistributedConfig
+from petals.utils.convert_block import QuantType, convert_block
 
 INITIAL_PEERS = os.environ.get("INITIAL_PEERS")
 if not INITIAL_PEERS:
@@ -13,3 +23,26 @@ if not MODEL_NAME:
 REF_NAME = os.environ.get("REF_NAME")
 
 ADAPTER_NAME = os.environ.get("ADAPTER_NAME")
+
+
+def make_backend(
+    block_index: int, memory_cache: MemoryCache, cache_dtype: Optional[torch.dtype] = None
+) -> TransformerBackend:
+    """Load a block of MODEL_NAME on CPU in float32 and wrap it into a TransformerBackend, e.g. to test runtime steps"""
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    block = load_pretrained_block(MODEL_NAME, block_index, config=config, torch_dtype=torch.float32)
+    block = convert_block(block, block_index, config, [torch.device("cpu")], torch.device("cpu"), QuantType.NONE)
+    schema = BatchTensorDescriptor(None, config.hidden_size, dtype=torch.float32)
+    return TransformerBackend(
+        f"block.{block_index}",
+        block,
+        config=config,
+        memory_cache=memory_cache,
+        backend_dtype=torch.float32,
+        cache_dtype=cache_dtype,
+        max_chunk_size_bytes=2**30,
+        args_schema=(schema,),
+        kwargs_schema={},
+        outputs_schema=(schema,),
+        max_batch_size=4096,
+    )